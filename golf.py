@@ -1,10 +1,26 @@
 from __future__ import division
 import re
+import sys
 import time
 import random
+import heapq
+import multiprocessing
+import threading
+import itertools
+import gzip
+import json
+import os
+import hashlib
+import cPickle as pickle
+import shutil
+import tempfile
+import errno
+import string
 import __builtin__
 from __builtin__ import any, all, sum # (because ipython imports the numpy versions)
-from collections import Counter
+from math import ceil
+from collections import Counter, defaultdict
+from StringIO import StringIO
 
 def verify(regex, winners, losers):
     "Return true iff the regex matches all winners but no losers."
@@ -16,58 +32,775 @@ def verify(regex, winners, losers):
         print "Error: should not match but did:", ', '.join(matched_losers)
     return not (missed_winners or matched_losers)
 
-def bb_findregex(winners, losers, calls=10000, restarts=10):
-    "Find the shortest disjunction of regex components that covers winners but not losers."
+def verify_files(regex, winners_path, losers_path, **options):
+    """Like verify, but for the User-Agents in two files, checked by verify_corpus
+    with these options. Return true iff there were no errors."""
+    missed_winners = verify_corpus(regex, winners_path, True, **options)
+    matched_losers = verify_corpus(regex, losers_path, False, **options)
+    if missed_winners:
+        print "Error: should match but did not:", ', '.join(missed_winners)
+    if matched_losers:
+        print "Error: should not match but did:", ', '.join(matched_losers)
+    return not (missed_winners or matched_losers)
+
+def verify_corpus(regex, path, expected=True, workers=1, chunksize=10000, stop_early=False,
+                  log=False):
+    """Stream the User-Agents of the file at path, as read_corpus(path, log) does, 
+    and check that regex matches each of them (if expected) or none of them (if not).
+    Repeated lines are checked once, in chunks spread over a pool of workers processes.
+    Return a Counter of {misclassified line: times seen}; if stop_early, stop at the 
+    first chunk with an error. Print the throughput."""
+    t0 = time.time()
+    counts = Counter()
+    def chunks():
+        chunk = []
+        for ua in read_corpus(path, log):
+            if ua not in counts:
+                chunk.append(ua)
+            counts[ua] += 1
+            if len(chunk) >= chunksize:
+                yield chunk
+                chunk = []
+        if chunk: 
+            yield chunk
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=compile_verifier, 
+                                    initargs=(regex, expected))
+        results = pool.imap_unordered(check_chunk, chunks())
+    else:
+        pool = None
+        compile_verifier(regex, expected)
+        results = itertools.imap(check_chunk, chunks())
+    errors = []
+    try:
+        for misclassified in results:
+            errors.extend(misclassified)
+            if errors and stop_early:
+                break
+    finally:
+        if pool: pool.terminate()
+    t1 = time.time()
+    print '{:11,d} UAs {:9,d} unique {:11,.0f} UAs/s {:6,d} errors: {}'.format(
+        sum(counts.values()), len(counts), sum(counts.values()) / max(t1 - t0, 1e-9), 
+        len(errors), path)
+    return Counter({ua: counts[ua] for ua in errors})
+
+def open_corpus(path):
+    "Open a file of lines for reading, decompressing it if it ends in '.gz'."
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+def read_corpus(path, log=False):
+    """Generate the User-Agents in the file at path (gzipped if it ends in '.gz'), one per
+    line, normalized as by phrases, skipping blank ones. If log, the file is an access 
+    log in the Combined Log Format, and each line's User-Agent is its last quoted field.
+    The file is streamed, so it can be larger than memory."""
+    for line in open_corpus(path):
+        ua = normalize(log_agent(line) if log else line).strip()
+        if ua:
+            yield ua
+
+def log_agent(line):
+    "The User-Agent of an access log line: its last double-quoted field ('' if none or '-')."
+    parts = line.rstrip().rsplit('"', 2)
+    agent = parts[1] if len(parts) == 3 and not parts[2] else ''
+    return '' if agent == '-' else agent
+
+def load_corpus(path, log=False, counts=False):
+    """Return the set of distinct User-Agents in the file at path, read as by read_corpus; 
+    or, if counts, a Counter of {User-Agent: times seen}. Only the distinct User-Agents
+    are held in memory."""
+    if counts:
+        return Counter(read_corpus(path, log))
+    return frozenset(read_corpus(path, log))
+
+def sample_corpus(counts, n, seed=None, strata=None):
+    """Return a set of n distinct User-Agents (or all, if there are fewer) from counts, a
+    Counter as from load_corpus, drawn without replacement with probability in proportion
+    to their counts: the n with the largest random() ** (1 / count). If strata is a 
+    function of a User-Agent, n is first split among its strata in proportion to their
+    total counts (rounded), with at least one each, so rare kinds of User-Agent are 
+    represented; so the sample can differ from n by up to one per stratum."""
+    rand = random.Random(seed)
+    def draw(uas, k):
+        return heapq.nlargest(k, uas, key=lambda ua: rand.random() ** (1 / counts[ua]))
+    if strata is None:
+        return set(draw(sorted(counts), n))
+    groups = defaultdict(list)
+    for ua in sorted(counts):
+        groups[strata(ua)].append(ua)
+    total = sum(counts.values())
+    return {ua for key in sorted(groups) 
+            for ua in draw(groups[key], 
+                           max(1, int(round(n * sum(counts[ua] for ua in groups[key]) / total))))}
+
+VERIFIER = {} # The compiled regex and expected result of a verify_corpus process
+
+def compile_verifier(regex, expected):
+    "Compile regex once, for check_chunk in this process."
+    VERIFIER.update(search=re.compile(regex).search, expected=expected)
+
+def check_chunk(chunk):
+    "Return the strings in chunk that the compiled regex misclassifies."
+    search, expected = VERIFIER['search'], VERIFIER['expected']
+    return [ua for ua in chunk if bool(search(ua)) != expected]
+
+def bb_findregex(winners, losers, calls=10000, restarts=10, workers=1, seed=None,
+                 engine=None, cache=None, stats=None, deadline=None, on_improve=None,
+                 cancel=None, covers=None):
+    """Find the shortest disjunction of regex components that covers winners but not losers.
+    Search: engine (BranchBoundRandom by default), calls, restarts, seed (see restart_search).
+    Parallel: workers > 1 runs the restarts in a process pool (see parallel_search).
+    Pool: covers (as from pair_bitcovers) or cache (a CoverCache, read and updated).
+    Anytime: deadline in seconds (half for generation), on_improve, cancel (see Anytime).
+    stats (a SearchStats), on_improve and cancel need workers=1."""
+    engine = engine or BranchBoundRandom
+    if stats and workers > 1:
+        raise ValueError('SearchStats can only follow a search in this process (workers=1)')
+    if (on_improve or cancel) and workers > 1:
+        raise ValueError('on_improve and cancel only work in this process (workers=1)')
+    t0 = time.time()
+    stop_at = t0 + deadline if deadline is not None else None
     solution = '^(' + OR(winners) + ')$'
-    bb = BranchBoundRandom(solution, calls)
-    covers = eliminate_dominated(regex_covers(winners, losers))
+    entry = cache.get(winners, losers) if cache else None
+    cut = False # Did generation skip candidates for lack of time?
+    if entry:
+        covers, solution = entry['covers'], min(entry['solution'], solution, key=len)
+    else:
+        if covers is None:
+            budget = Budget(t0 + deadline / 2) if deadline is not None else None
+            _, covers = regex_bitcovers(winners, losers, budget)
+            cut = budget is not None and budget.cut
+        covers = eliminate_dominated_bits(covers)
+    if workers > 1 and engine.randomized: # Restarts of a deterministic engine would repeat
+        bb = parallel_search(covers, solution, calls, restarts, workers, seed, engine, stop_at)
+    else:
+        bb = restart_search(covers, solution, calls, restarts, seed, engine, stats=stats,
+                            stop_at=stop_at, on_improve=on_improve, cancel=cancel)
+    if cache and not cut and (not entry or len(bb.solution) < len(entry['solution'])):
+        cache.put(winners, losers, {'covers': covers, 'solution': bb.solution})
+    return bb
+
+def bb_findpair(A, B, **options):
+    """Return (bb_findregex(A, B, **options), bb_findregex(B, A, **options)), with the 
+    cover pools of both directions made together by pair_bitcovers (unless both are 
+    in the cache, or a deadline is given, which only bb_findregex's own generation 
+    keeps to, in each direction)."""
+    cache = options.get('cache')
+    if (options.get('deadline') is not None 
+        or (cache and cache.get(A, B) and cache.get(B, A))):
+        forward = reverse = None
+    else:
+        (_, forward), (_, reverse) = pair_bitcovers(A, B)
+    return (bb_findregex(A, B, covers=forward, **options), 
+            bb_findregex(B, A, covers=reverse, **options))
+
+def restart_search(covers, solution, calls, restarts, seed=None, engine=None, partial=None,
+                   stats=None, stop_at=None, on_improve=None, cancel=None):
+    """Run up to restarts searches on covers (extending partial), one after another, each
+    starting from the best solution so far; stop after one that was not cut off. 
+    If seed is given, restart k is seeded with seed + k. The engine's restarts attribute
+    says how many searches ran. If stats is given, the engine reports to it, and the 
+    time of each whole search is added to it. If any of stop_at, on_improve or cancel 
+    is given, the engine is made Anytime with them."""
+    engine = engine or BranchBoundRandom
+    if stats and not issubclass(engine, BranchBoundRandom):
+        raise ValueError('SearchStats needs BranchBoundRandom or BranchBoundUndo, not ' 
+                         + engine.__name__)
+    if stop_at or on_improve or cancel:
+        engine = type('Anytime' + engine.__name__, (Anytime, engine), {})
+    bb = engine(solution, calls)
+    bb.stats = stats
+    bb.stop_at, bb.on_improve, bb.cancel, bb.reported = stop_at, on_improve, cancel, len(solution)
     for restart in range(restarts):
-        bb.calls = calls
-        bb.search(covers.copy())
-        if bb.calls > 0: 
+        if seed is not None: random.seed(seed + restart)
+        bb.calls, bb.restarts = calls, restart + 1
+        t0 = time.time()
+        bb.search(covers, partial) # No engine leaves covers changed
+        if stats: 
+            stats.search_seconds += time.time() - t0
+        if on_improve: 
+            bb.report()
+        if bb.calls > 0 or not bb.randomized or getattr(bb, 'stopped', False): 
             return bb # If search was not cut off, then stop
     return bb
 
 class BranchBoundRandom(object):
 
+    randomized = True
+    stats = None # Or a SearchStats to report to
+
     def __init__(self, solution, calls):
         self.solution, self.calls = solution, calls
 
+    def bound(self):
+        "Partial solutions must be shorter than this to be worth extending."
+        return len(self.solution)
+
     def search(self, covers, partial=None):
         """Recursively extend partial regex until it matches all winners in covers.
-        Try all reasonable combinations until we run out of calls."""
+        Try all reasonable combinations until we run out of calls.
+        Here covers is a dict of {regex: bits}, as made by bitcovers."""
         if self.calls <= 0: 
             return partial, covers
         self.calls -= 1
-        covers, partial = simplify_covers(covers, partial)
+        stats = self.stats
+        if stats:
+            covers, partial = stats.simplify(covers, partial)
+        else:
+            covers, partial = simplify_bitcovers(covers, partial)
         if not covers: # Nothing left to cover; solution is complete
+            if stats and len(partial) < len(self.solution): 
+                stats.event('improve', partial)
             self.solution = min(partial, self.solution, key=len)
-        elif len(OR(partial, min(covers, key=len))) < len(self.solution):
+        elif len(OR(partial, min(covers, key=len))) < self.bound():
+            if stats: 
+                stats.event('expand')
             # Try with and without the greedy-best component
             K = random.choice((2, 3, 4, 4, 5, 6))
             F = random.choice((1., 1., 2.))
-            def score(c): return K * len(covers[c]) - len(c) + random.uniform(0., F)
-            best = max(covers, key=score) # Best component
-            covered = covers[best] # Set of winners covered by r
+            def score(c): return K * popcount(covers[c]) - len(c) + random.uniform(0., F)
+            best = max(sorted(covers), key=score) # Best component (in a fixed order)
+            covered = covers[best] # Bits of winners covered by r
             covers.pop(best)
-            self.search({c:covers[c]-covered for c in covers}, OR(partial, best))
+            self.search({c:covers[c] & ~covered for c in covers}, OR(partial, best))
             self.search(covers, partial)
+        elif stats:
+            stats.event('prune')
+        return self.solution
+
+SIMPLIFY = 'search;simplify_covers' # The folded stacks that SearchStats times
+ELIMINATE = SIMPLIFY + ';eliminate_dominated'
+SELECT = SIMPLIFY + ';select_necessary'
+
+class SearchStats(object):
+    """Opt-in instrumentation for BranchBoundRandom and BranchBoundUndo; set the engine's
+    stats attribute (or pass stats to bb_findregex) to one of these. It counts the nodes
+    expanded and the nodes pruned by the length bound, the fixpoint iterations of each
+    simplify_covers (as a Counter of {iterations: times}; BranchBoundRandom only), and 
+    the improvements as (seconds since the stats were made, solution). It times each 
+    helper as a folded stack, like 'search;simplify_covers', for dump_folded. If 
+    callback is given, it is called as callback(event, stats) for each 'expand', 
+    'prune' and 'improve' event."""
+
+    def __init__(self, callback=None):
+        self.callback, self.start = callback, time.time()
+        self.expanded = self.pruned = 0
+        self.iterations = Counter()
+        self.improvements = []
+        self.seconds = Counter() # {folded stack: seconds spent in its last frame}
+        self.search_seconds = 0. # Total time in whole searches, as timed by restart_search
+        self.calls = Counter() # {folded stack: times called}
+        self.eliminate = self.timer(ELIMINATE, eliminate_dominated_bits)
+        self.select = self.timer(SELECT, select_necessary_bits)
+
+    def event(self, kind, solution=None):
+        "Record an 'expand', 'prune' or 'improve' event, and tell the callback."
+        if kind == 'expand':
+            self.expanded += 1
+        elif kind == 'prune':
+            self.pruned += 1
+        else:
+            self.improvements.append((time.time() - self.start, solution))
+        if self.callback:
+            self.callback(kind, self)
+
+    def timer(self, stack, fn):
+        "Return a version of fn that adds its calls and time under stack."
+        def timed(*args):
+            t0 = time.time()
+            result = fn(*args)
+            self.seconds[stack] += time.time() - t0
+            self.calls[stack] += 1
+            return result
+        return timed
+
+    def simplify(self, covers, partial=None):
+        "Run simplify_bitcovers with timed helpers, and count its iterations."
+        t0, iterations = time.time(), self.calls[ELIMINATE]
+        helpers = self.seconds[ELIMINATE] + self.seconds[SELECT]
+        covers, partial = simplify_bitcovers(covers, partial, self.eliminate, self.select)
+        self.iterations[self.calls[ELIMINATE] - iterations] += 1
+        helpers = self.seconds[ELIMINATE] + self.seconds[SELECT] - helpers
+        self.seconds[SIMPLIFY] += time.time() - t0 - helpers
+        return covers, partial
+
+    def cumulative(self, helper):
+        "The total seconds spent in helper, including the helpers it calls."
+        return sum(secs for (stack, secs) in self.folded() if helper in stack.split(';'))
+
+    def folded(self):
+        "Pairs of (folded stack, seconds in its last frame), including search itself."
+        search = self.search_seconds - sum(self.seconds.values())
+        return sorted(self.seconds.items()) + ([('search', search)] if search > 0 else [])
+
+    def dump_folded(self, file=sys.stdout):
+        """Write the times as 'stack microseconds' lines, the folded stack format read by 
+        flamegraph.pl, speedscope and similar profilers."""
+        for (stack, secs) in self.folded():
+            print >> file, stack, int(round(1e6 * secs))
+
+class BranchBoundUndo(BranchBoundRandom):
+    """The same search as BranchBoundRandom (with the same seed, the same tree of calls), 
+    but instead of building new covers dicts at every node, it changes one dict in place
+    and logs each change on an undo stack, so that backtracking restores the dict."""
+
+    def search(self, covers, partial=None):
+        "Search from covers, a dict of {regex: bits}, which is restored on return."
+        self.covers, self.undo = covers, [] # undo holds (regex, bits) to put back
+        self.extend(partial)
+        return self.solution
+
+    def extend(self, partial, dominated=True):
+        """Extend partial until it covers all of self.covers, then restore self.covers.
+        If not dominated, self.covers is known to hold no dominated regexes."""
+        if self.calls <= 0:
+            return
+        self.calls -= 1
+        covers, mark, stats = self.covers, len(self.undo), self.stats
+        if stats:
+            t0 = time.time()
+            partial = self.simplify(partial, dominated)
+            stats.seconds[SIMPLIFY] += time.time() - t0
+        else:
+            partial = self.simplify(partial, dominated)
+        if not covers: # Nothing left to cover; solution is complete
+            if stats and len(partial) < len(self.solution): 
+                stats.event('improve', partial)
+            self.solution = min(partial, self.solution, key=len)
+        elif len(OR(partial, min(covers, key=len))) < self.bound():
+            if stats: 
+                stats.event('expand')
+            # Try with and without the greedy-best component
+            K = random.choice((2, 3, 4, 4, 5, 6))
+            F = random.choice((1., 1., 2.))
+            def score(c): return K * popcount(covers[c]) - len(c) + random.uniform(0., F)
+            best = max(sorted(covers), key=score) # Best component (in a fixed order)
+            covered = covers[best] # Bits of winners covered by r
+            self.remove([best])
+            take = len(self.undo)
+            self.subtract(covered)
+            self.extend(OR(partial, best))
+            self.rollback(take)
+            self.extend(partial, False) # Removing best leaves nothing newly dominated
+        elif stats:
+            stats.event('prune')
+        self.rollback(mark)
+
+    def simplify(self, partial, dominated=True):
+        """Like simplify_bitcovers, but change self.covers in place. If not dominated, 
+        skip the first check for dominated regexes."""
+        covers = self.covers
+        while True:
+            kept = undominated_bits(covers) if dominated else covers
+            if len(kept) < len(covers): # Remove the dominated regexes in place
+                kept = set(kept)
+                self.remove([r for r in covers if r not in kept])
+            dominated = True
+            unique = unique_bits(covers)
+            necessary = [r for r in covers if covers[r] & unique]
+            if not necessary:
+                return partial
+            covered = union_bits(covers[r] for r in necessary)
+            self.remove(necessary)
+            self.subtract(covered)
+            partial = OR(partial, OR(necessary))
+
+    def remove(self, regexes):
+        "Remove regexes from self.covers."
+        for r in regexes:
+            self.undo.append((r, self.covers.pop(r)))
+
+    def subtract(self, covered):
+        "Remove the winners in covered from every regex in self.covers."
+        covers = self.covers
+        for r in covers:
+            if covers[r] & covered:
+                self.undo.append((r, covers[r]))
+                covers[r] &= ~covered
+
+    def rollback(self, mark):
+        "Undo changes to self.covers until the undo stack is back to length mark."
+        covers, undo = self.covers, self.undo
+        while len(undo) > mark:
+            r, bits = undo.pop()
+            covers[r] = bits
+
+class BestFirstSearch(object):
+    """A deterministic alternative to BranchBoundRandom, with the same interface.
+    It does a best-first (A*) search over the set of winners still uncovered, with
+    cover_lower_bound as the estimate of the remaining length, and remembers the
+    cheapest way each residual set was reached. It starts from a greedy solution,
+    so it has an answer at any time. If the search is not cut off (calls > 0
+    afterwards), then self.solution is proved shortest for these covers."""
+
+    randomized = False # Restarts would repeat the same search
+
+    def __init__(self, solution, calls):
+        self.solution, self.calls = solution, calls
+
+    def bound(self):
+        "Partial solutions must be shorter than this to be worth extending."
+        return len(self.solution)
+
+    def search(self, covers, partial=None):
+        """Search covers, a dict of {regex: bits}, for the shortest OR of regexes 
+        (added to partial) that covers every winner. Costs count len(r) + 1 per regex."""
+        start = union_bits(covers.values())
+        g0 = len(partial) + 1 if partial else 0
+        # Entries are (f, exact, g, uncovered, parts). A child is pushed with its parent's
+        # f, which is still a lower bound, and its own bound is computed when it is popped.
+        frontier = [(g0, False, g0, start, (partial,))]
+        seen = {start: g0} # {uncovered winners: cheapest cost so far}
+        while frontier and self.calls > 0:
+            (f, exact, g, uncovered, parts) = heapq.heappop(frontier)
+            if g > seen[uncovered]:
+                continue # Reached more cheaply since this was pushed
+            if ceil(f - 1) >= self.bound():
+                break # Nothing left can beat self.solution
+            if not exact:
+                f = max(f, g + cover_lower_bound(covers, uncovered))
+                heapq.heappush(frontier, (f, True, g, uncovered, parts))
+                continue
+            self.calls -= 1
+            if not uncovered: # f is admissible, so this is the shortest
+                self.solution = OR(parts)
+                break
+            residual = eliminate_dominated_bits({r: covers[r] & uncovered for r in covers})
+            self.greedy(residual, OR(parts))
+            # Branch on the winner with the fewest regexes that cover it
+            i = min(members(uncovered), 
+                    key=lambda i: sum(residual[r] >> i & 1 for r in residual))
+            for r in sorted(residual, key=lambda r: (len(r), r)):
+                if residual[r] >> i & 1:
+                    uncovered2, g2 = uncovered & ~residual[r], g + len(r) + 1
+                    if seen.get(uncovered2, g2 + 1) > g2:
+                        seen[uncovered2] = g2
+                        heapq.heappush(frontier, (max(f, g2), not uncovered2, g2,
+                                                  uncovered2, parts + (r,)))
         return self.solution
 
+    def greedy(self, covers, partial=None):
+        "Cover everything by repeatedly taking the regex with most new winners per character."
+        uncovered, parts = union_bits(covers.values()), [partial]
+        regexes = sorted(covers)
+        while uncovered:
+            r = max(regexes, key=lambda r: popcount(covers[r] & uncovered) / (len(r) + 1))
+            uncovered &= ~covers[r]
+            parts.append(r)
+        self.solution = min(OR(parts), self.solution, key=len)
+
+def cover_lower_bound(covers, uncovered):
+    """A lower bound on the cost (sum of len(r) + 1) of any regexes in covers that cover 
+    all the winners in uncovered. Every winner must pay for at least the cheapest regex 
+    that covers it, and the winners together pay at least the sum of their cheapest 
+    share of a regex's cost, shared among the uncovered winners it covers."""
+    cheapest, share = {}, {} # {i: cost}, for each uncovered winner i
+    for r in covers:
+        bits = covers[r] & uncovered
+        if bits:
+            cost, winners = len(r) + 1, members(bits)
+            for i in winners:
+                cheapest[i] = min(cheapest.get(i, cost), cost)
+                share[i] = min(share.get(i, cost), cost / len(winners))
+    if len(cheapest) < popcount(uncovered):
+        return float('inf') # Some winner can't be covered at all
+    return max(sum(share.values()), max(cheapest.values() or [0])) - 1e-9
+
+class SharedBound(object):
+    """Mixin for a search engine that prunes with the shortest solution length found by
+    any process, publishes its own improvements, and gives up as soon as any process 
+    has finished an uncut search. Needs best, a multiprocessing.Value('i'), and done, 
+    a multiprocessing.RawValue('b')."""
+
+    def bound(self):
+        if len(self.solution) < self.best.value: # Publish the improvement
+            with self.best.get_lock():
+                self.best.value = min(self.best.value, len(self.solution))
+        if self.done.value:
+            self.calls = 0
+            return 0
+        return min(super(SharedBound, self).bound(), self.best.value)
+
+class Anytime(object):
+    """Mixin for a search engine that stops cleanly, as if out of calls, once time.time() 
+    passes stop_at or the cancel event (a threading.Event) is set, and that calls 
+    on_improve(solution) for each solution shorter than reported. Needs those four 
+    attributes; any but reported may be None."""
+
+    stopped = False
+
+    def bound(self):
+        self.report()
+        if ((self.stop_at is not None and time.time() > self.stop_at) 
+            or (self.cancel is not None and self.cancel.is_set())):
+            self.stopped, self.calls = True, 0
+            return 0
+        return super(Anytime, self).bound()
+
+    def report(self):
+        "Call on_improve if self.solution is shorter than any reported so far."
+        if self.on_improve and len(self.solution) < self.reported:
+            self.reported = len(self.solution)
+            self.on_improve(self.solution)
+
+SHARED = {} # The shared bound and done flag of a parallel_search worker process
+
+def parallel_search(covers, solution, calls, restarts, workers, seed=None, 
+                    engine=None, stop_at=None):
+    """Run restarts independent searches on covers in a pool of workers processes, with
+    engine made into an Anytime that stops at stop_at, if given. Without a seed, engine
+    is also made into a SharedBound, so each search prunes with the best length found 
+    so far by any of them. With a seed, restart k is seeded with seed + k, and to make 
+    the result depend only on seed (if the searches are not stopped at stop_at), the 
+    restarts run in rounds of workers searches that share nothing: each round starts
+    from the shortest solution of the rounds before it, and is the last one if any of
+    its searches was not cut off. Return a BranchBoundRandom holding the shortest 
+    solution; its calls are left over iff some search was not cut off."""
+    engine = engine or BranchBoundRandom
+    best = multiprocessing.Value('i', len(solution))
+    done = multiprocessing.RawValue('b', False)
+    pool = multiprocessing.Pool(workers, initializer=SHARED.update, 
+                                initargs=({'best': best, 'done': done},))
+    try:
+        if seed is None:
+            tasks = [(covers, solution, calls, None, engine, stop_at, True)] * restarts
+            results = pool.map(bb_restart, tasks, chunksize=1)
+        else:
+            results = []
+            for start in range(0, restarts, workers):
+                tasks = [(covers, solution, calls, seed + k, engine, stop_at, False)
+                         for k in range(start, min(start + workers, restarts))]
+                results += pool.map(bb_restart, tasks, chunksize=1)
+                solution = min([sol for (sol, _) in results], key=len)
+                if any(left > 0 for (_, left) in results):
+                    break # A search was not cut off
+    finally:
+        pool.terminate()
+    bb = BranchBoundRandom(min([sol for (sol, _) in results], key=len), calls)
+    bb.calls = max(left for (_, left) in results)
+    return bb
+
+def bb_restart((covers, solution, calls, seed, engine, stop_at, shared)):
+    """Run one parallel_search restart in a worker process, with the SharedBound if shared;
+    return (solution, calls left)."""
+    if seed is not None: random.seed(seed)
+    mixins = ((SharedBound,) if shared else ()) + ((Anytime,) if stop_at else ())
+    bb = type('Worker' + engine.__name__, mixins + (engine,), {})(solution, calls)
+    bb.best, bb.done = SHARED['best'], SHARED['done']
+    bb.stop_at, bb.on_improve, bb.cancel, bb.reported = stop_at, None, None, len(solution)
+    bb.search(covers)
+    if shared and bb.calls > 0 and not SHARED['done'].value: 
+        SHARED['done'].value = True # Search was not cut off; others can stop
+    return bb.solution, bb.calls
+
+class BackgroundSearch(object):
+    """Run bb_findregex(winners, losers, **options) in a daemon thread, so that an event 
+    loop or pipeline can carry on meanwhile. Like a concurrent.futures.Future, it has 
+    done(), result(timeout) and add_done_callback(fn); cancel() stops the search cleanly 
+    (after candidate generation), so that result() is the best solution so far, which 
+    is also kept up to date in self.best (so workers must be 1). From an asyncio loop, 
+    await loop.run_in_executor(None, search.result), and call search.cancel() on 
+    cancellation."""
+
+    def __init__(self, winners, losers, **options):
+        self.stop, self.finished, self.lock = threading.Event(), threading.Event(), threading.Lock()
+        self.best, self.error, self.callbacks = None, None, []
+        on_improve = options.get('on_improve')
+        def improved(solution):
+            self.best = solution
+            if on_improve: 
+                on_improve(solution)
+        options.update(on_improve=improved, cancel=self.stop)
+        self.thread = threading.Thread(target=self.run, args=(winners, losers, options))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, winners, losers, options):
+        try:
+            self.best = bb_findregex(winners, losers, **options).solution
+        except Exception as error:
+            self.error = error
+        with self.lock:
+            self.finished.set()
+            callbacks = self.callbacks
+        for fn in callbacks:
+            fn(self)
+
+    def cancel(self):
+        "Stop the search cleanly; result() will be the best solution so far."
+        self.stop.set()
+        return True
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        "Wait up to timeout seconds (or forever) for the search; return its solution."
+        if not self.finished.wait(timeout):
+            raise RuntimeError('search still running after {} seconds'.format(timeout))
+        if self.error:
+            raise self.error
+        return self.best
+
+    def add_done_callback(self, fn):
+        "Call fn(self) when the search is done (now, if it already is)."
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
 def regex_covers(winners, losers):
     """Generate regex components and return a dict of {regex: {winner...}}.
     Each regex matches at least one winner and no loser."""
-    losers_str = '\n'.join(losers)
+    return setcovers(*regex_bitcovers(winners, losers))
+
+def regex_bitcovers(winners, losers, budget=None):
+    """Like regex_covers, but return (winners, {regex: bits}) as made by bitcovers,
+    without ever building sets of winner strings. If a Budget is given, spend the first
+    half of its time compiling candidates and the rest matching them, and return the 
+    ones matched, plus the whole winners '^w$' not matched (with just the bit of w), so
+    that the pool still covers every winner (that no loser equals). budget.cut is then
+    set if any candidate was left out."""
+    winners = sorted(winners)
+    compiling = budget and Budget((time.time() + budget.stop_at) / 2)
+    searchers = candidate_searchers(winners, losers, budget=compiling)
+    covers = match_bits(searchers, winners, budget=budget)
+    for (i, w) in enumerate(winners):
+        if '^'+w+'$' in searchers and '^'+w+'$' not in covers:
+            covers['^'+w+'$'] = 1 << i
+    if compiling and compiling.cut:
+        budget.cut = True
+    return winners, covers
+
+def pair_bitcovers(A, B):
+    """Return (regex_bitcovers(A, B), regex_bitcovers(B, A)), less the regexes that cover
+    nothing, compiling the candidates of both directions just once. Each side's own 
+    candidates are pruned against the other side, as in regex_bitcovers; the character
+    pairs, which the two sides mostly share, are compiled once and matched against both."""
+    A, B = sorted(A), sorted(B)
+    pairs = compile_searchers(char_pairs(set(cat(A))) | char_pairs(set(cat(B))))
+    forward = match_bits(candidate_searchers(A, B, pairs=set()), A)
+    forward.update(match_bits(pairs, A, B))
+    reverse = match_bits(candidate_searchers(B, A, pairs=set()), B)
+    reverse.update(match_bits(pairs, B, A))
+    return ((A, {r: bits for (r, bits) in forward.items() if bits}),
+            (B, {r: bits for (r, bits) in reverse.items() if bits}))
+
+def regex_candidates(winners):
+    """Return the set of regex components generated from winners: whole winners, 
+    dotted subparts, their repetitions, and pairs of characters. This is the pool 
+    that candidate_searchers prunes."""
     wholes = {'^'+winner+'$' for winner in winners}
     parts = {d for w in wholes for p in subparts(w) for d in dotify(p)}
-    chars = set(cat(winners))
-    pairs = {A+'.'+q+B for A in chars for B in chars for q in rep_chars}
     reps = {r for p in parts for r in repetitions(p)}
-    pool = wholes | parts | pairs | reps                         
-    searchers = [re.compile(c, re.MULTILINE).search for c in pool]
-    return {r: set(filter(searcher, winners)) 
-            for (r, searcher) in zip(pool, searchers)
-            if not searcher(losers_str)}
+    return wholes | parts | char_pairs(set(cat(winners))) | reps
+
+def candidate_searchers(winners, losers, pairs=None, budget=None):
+    """Return a dict of {regex: search function} for the regexes of regex_candidates(winners)
+    (but with pairs instead of char_pairs, if given) that match no loser. Dotted parts 
+    found in loser_parts are dropped before they are compiled, and so are repetitions
+    that match a part in loser_parts when repeated zero times. Repetitions are only
+    made from parts that match no loser, since a repetition matches wherever its part does.
+    If a Budget is given, the whole winners are always compiled, but then the rest are
+    compiled a chunk at a time (parts, then pairs, then repetitions of parts), shortest
+    (and most general) first, stopping once the budget is spent."""
+    losers_str = '\n'.join(losers)
+    def survivors(pool, budget=budget): 
+        if budget is None:
+            return {r: search for (r, search) in compile_searchers(pool).items()
+                    if not search(losers_str)}
+        found = {} # Compile and test chunks, shortest first, while there is time
+        for chunk in chunked(sorted(pool, key=lambda r: (len(r), r))):
+            if budget.spent():
+                break
+            found.update(survivors(chunk, None))
+        return found
+    wholes = {'^'+winner+'$' for winner in winners}
+    known = loser_parts(losers)
+    parts = {d for w in wholes for p in subparts(w) for d in dotify(p)
+             if not (d in known and plain(d))}
+    searchers = survivors(wholes, None)
+    searchers.update(survivors(parts - wholes))
+    if pairs is None: 
+        pairs = char_pairs(set(cat(winners)))
+    searchers.update(survivors(pairs - set(searchers)))
+    for some in (chunked(sorted(parts, key=lambda p: (len(p), p)), 100) if budget else [parts]):
+        if budget and budget.spent():
+            break # Making all the repetitions at once could take longer than the budget
+        reps = {r for p in some if p in searchers for r in repetitions(p)
+                if r not in searchers and not (plain(p) and erased(r) in known)}
+        searchers.update(survivors(reps, None))
+    return searchers
+
+def loser_parts(losers):
+    """The set of all dotified subparts of '^' + loser + '$', for losers without '^', '$'
+    or newlines. A plain part in this set is sure to match a loser."""
+    return {d for L in losers if not any(c in L for c in '^$\n')
+            for p in subparts('^'+L+'$') for d in dotify(p)}
+
+def erased(rep):
+    """The regex that rep, from repetitions of a plain part, reduces to when its '*' or '?'
+    repeats zero times; None if it uses '+'."""
+    for q in '*?':
+        if q in rep:
+            i = rep.index(q)
+            return rep[:i-1] + rep[i+1:]
+    return None
+
+def plain(part):
+    "Is part made of literal characters and '.', with anchors only at its ends?"
+    return (not any(c in part for c in '\\[](){}|*+?') 
+            and '^' not in part[1:] and '$' not in part[:-1])
+
+def char_pairs(chars):
+    "Return the regexes A.*B, A.+B and A.?B for all chars A and B."
+    return {A+'.'+q+B for A in chars for B in chars for q in rep_chars}
+
+def compile_searchers(pool):
+    "Return a dict of {regex: search function} for each regex in pool."
+    return {c: re.compile(c, re.MULTILINE).search for c in pool}
+
+def match_bits(searchers, winners, losers=None, budget=None):
+    """Given a dict of {regex: search function}, return a dict of {regex: bits} for 
+    each regex that matches no loser (all of them if losers is None), where bit i is 
+    set iff it matches winners[i]. If a Budget is given, match the shortest regexes first,
+    and stop (between chunks) once it is spent, leaving out the rest."""
+    index = {w: 1 << i for (i, w) in enumerate(winners)}
+    if losers is not None:
+        losers_str = '\n'.join(losers)
+        searchers = {r: search for (r, search) in searchers.items() if not search(losers_str)}
+    if budget is None:
+        return {r: sum(map(index.get, filter(searcher, winners)))
+                for (r, searcher) in searchers.items()}
+    covers = {}
+    for chunk in chunked(sorted(searchers.items(), key=lambda (r, _): (len(r), r))):
+        if budget.spent():
+            break
+        covers.update((r, sum(map(index.get, filter(searcher, winners))))
+                      for (r, searcher) in chunk)
+    return covers
+
+class Budget(object):
+    """The time left for generating candidates: until time.time() passes stop_at.
+    Whoever skips work because the budget is spent() leaves cut set."""
+
+    def __init__(self, stop_at):
+        self.stop_at, self.cut = stop_at, False
+
+    def spent(self):
+        "Has time run out? If so, the caller is expected to skip the rest of its work."
+        if time.time() > self.stop_at:
+            self.cut = True
+        return self.cut
+
+def chunked(items, size=1000):
+    "Generate lists of up to size consecutive items."
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(items, size))
 
 def repetitions(part):
     """Return a set of strings derived by inserting a single repetition character ('+' or '*' or '?') 
@@ -85,40 +818,134 @@ rep_chars = ('*', '+', '?')
 
 def simplify_covers(covers, partial=None):
     "Eliminate dominated regexes, and select ones that uniquely cover a winner."
+    winners, covers = bitcovers(covers)
+    covers, partial = simplify_bitcovers(covers, partial)
+    return setcovers(winners, covers), partial
+
+def eliminate_dominated(covers):
+    """Given a dict of {regex: {winner...}}, make a new dict with only the regexes
+    that are not dominated by any others. A regex r is dominated by r2 if r2 covers 
+    a superset of the matches covered by r, and r2 is shorter."""
+    winners, covers = bitcovers(covers)
+    return setcovers(winners, eliminate_dominated_bits(covers))
+
+def select_necessary(covers):
+    """Select winners covered by only one component; remove from covers.
+    Return a pair of (covers, necessary)."""
+    winners, covers = bitcovers(covers)
+    covers, necessary = select_necessary_bits(covers)
+    return setcovers(winners, covers), necessary
+
+##############################################################################
+# The solver works on bit covers: each winner is indexed once, and a regex's
+# coverage is an int whose bit i is set iff it matches winners[i]. Subset
+# tests, differences and counts are then integer operations.
+
+def bitcovers(covers):
+    """Convert a dict of {regex: {winner...}} into a pair (winners, {regex: bits}),
+    where winners is a sorted list and bit i of bits is set iff regex covers winners[i]."""
+    winners = sorted({w for r in covers for w in covers[r]})
+    index = {w: 1 << i for (i, w) in enumerate(winners)}
+    return winners, {r: sum(index[w] for w in covers[r]) for r in covers}
+
+def setcovers(winners, covers):
+    "Convert a pair (winners, {regex: bits}) back into a dict of {regex: {winner...}}."
+    return {r: {winners[i] for i in members(covers[r])} for r in covers}
+
+def popcount(bits): 
+    "The number of winners covered by bits."
+    return bin(bits).count('1')
+
+def members(bits):
+    "The indexes of the winners covered by bits."
+    indexes = []
+    while bits:
+        low = bits & -bits
+        indexes.append(low.bit_length() - 1)
+        bits ^= low
+    return indexes
+
+def simplify_bitcovers(covers, partial=None, eliminate=None, select=None):
+    """Like simplify_covers, but for a dict of {regex: bits}. Versions of the helpers 
+    eliminate_dominated_bits and select_necessary_bits (such as the timed ones of a 
+    SearchStats) can be given as eliminate and select."""
+    eliminate = eliminate or eliminate_dominated_bits
+    select = select or select_necessary_bits
     previous = None
     while covers != previous:
         previous = covers
-        covers = eliminate_dominated(covers)
-        covers, necessary = select_necessary(covers)
+        covers = eliminate(covers)
+        covers, necessary = select(covers)
         partial = OR(partial, necessary)
     return covers, partial
 
-def eliminate_dominated(covers):
-    """Given a dict of {regex: {winner...}}, make a new dict with only the regexes
-    that are not dominated by any others. A regex r is dominated by r2 if r2 covers 
-    a superset of the matches covered by r, and r2 is shorter."""
+def eliminate_dominated_bits(covers):
+    "Like eliminate_dominated, but for a dict of {regex: bits}."
+    return {r: covers[r] for r in undominated_bits(covers)}
+
+def undominated_bits(covers):
+    """The list of regexes in covers, a dict of {regex: bits}, that eliminate_dominated_bits
+    keeps. Only the best regex with a given cover can survive, so dominance is checked once
+    per distinct cover, and only against kept covers that share its rarest winner."""
+    best = {} # {bits: regex}
+    for r in covers:
+        bits = covers[r]
+        if bits and (bits not in best or (len(r), r) < (len(best[bits]), best[bits])):
+            best[bits] = r
+    kept = []
+    index = defaultdict(list) # {i: [(bits2, len(r2)) for each kept r2 that covers winner i]}
+    def signature(bits): return (-popcount(bits), len(best[bits]), best[bits])
+    for bits in sorted(best, key=signature):
+        r = best[bits]
+        # Any dominator must cover every winner of r, including the rarest one
+        candidates = min((index[i] for i in members(bits)), key=len)
+        if not any(bits | bits2 == bits2 and n2 <= len(r) for (bits2, n2) in candidates):
+            kept.append(r)
+            for i in members(bits):
+                index[i].append((bits, len(r)))
+    return kept
+
+def eliminate_dominated_pairwise(covers):
+    """Reference version of eliminate_dominated_bits that checks each regex against 
+    every regex already kept; O(n**2). Used by test_bb and benchmark_dominated."""
     newcovers = {}
-    def signature(r): return (-len(covers[r]), len(r))
+    def signature(r): return (-popcount(covers[r]), len(r), r)
     for r in sorted(covers, key=signature):
-        if not covers[r]: break # All remaining r must not cover anything
-        # r goes in newcache if it is not dominated by any other regex
-        if not any(covers[r2] >= covers[r] and len(r2) <= len(r) 
+        bits = covers[r]
+        if not bits: break # All remaining r must not cover anything
+        if not any(bits | newcovers[r2] == newcovers[r2] and len(r2) <= len(r)
                    for r2 in newcovers):
-            newcovers[r] = covers[r]
+            newcovers[r] = bits
     return newcovers
 
-def select_necessary(covers):
-    """Select winners covered by only one component; remove from covers.
-    Return a pair of (covers, necessary)."""
-    counts = Counter(w for r in covers for w in covers[r])
-    necessary = {r for r in covers if any(counts[w] == 1 for w in covers[r])}
+def select_necessary_bits(covers):
+    "Like select_necessary, but for a dict of {regex: bits}."
+    unique = unique_bits(covers)
+    necessary = {r for r in covers if covers[r] & unique}
     if necessary:
-        covered = {w for r in necessary for w in covers[r]}
-        covers = {r:covers[r]-covered for r in covers if r not in necessary}
+        covered = union_bits(covers[r] for r in necessary)
+        covers = {r:covers[r] & ~covered for r in covers if r not in necessary}
         return covers, OR(necessary)
     else:
         return covers, None
 
+def unique_bits(covers):
+    "The bits of the winners that are covered by exactly one regex in covers."
+    once = twice = 0
+    for bits in covers.values():
+        twice |= once & bits
+        once |= bits
+    return once & ~twice
+
+def union_bits(bitsets):
+    "The bits of the winners covered by any of bitsets."
+    union = 0
+    for bits in bitsets:
+        union |= bits
+    return union
+
+##############################################################################
+
 def OR(*regexes):
     """OR together component regexes. Ignore 'None' components.
     Allows both OR(a, b, c) and OR([a, b, c]), similar to max."""
@@ -160,6 +987,195 @@ def better_solution(W, L):
     return min(SOLUTION[W, L], negative_lookahead_solution(W, L),
                key=len)
 
+def solve(winners, losers, calls=10000, restarts=10, engine=None):
+    """Solve from scratch, and return a state that update can extend: a dict with the 
+    winners (a list; bit i of a cover is winners[i]), the losers, the full cover pool
+    with the compiled search function of each of its regexes, and the solution."""
+    winners = sorted(winners)
+    searchers = candidate_searchers(winners, losers)
+    pool = match_bits(searchers, winners)
+    state = {'winners': winners, 'losers': frozenset(losers), 'pool': pool, 
+             'searchers': searchers}
+    return resolve(state, '^(' + OR(winners) + ')$', calls, restarts, engine)
+
+def update(state, added_winners=(), added_losers=(), calls=10000, restarts=10, engine=None):
+    """Return a new state for the winners and losers of state plus the added ones. 
+    Existing regexes are only tested against the new strings, new regexes are only 
+    generated from the new winners, and the search starts from the old solution."""
+    old_winners, old_losers = state['winners'], state['losers']
+    added_winners = sorted(set(added_winners) - set(old_winners))
+    added_losers = frozenset(added_losers) - old_losers
+    winners, losers = old_winners + added_winners, old_losers | added_losers
+    # Drop old regexes that match a new loser; add bits for the new winners they match
+    shift = len(old_winners)
+    newbits = match_bits(state['searchers'], added_winners, added_losers)
+    pool = {r: state['pool'][r] | newbits[r] << shift for r in newbits}
+    searchers = {r: state['searchers'][r] for r in pool}
+    # New regexes come only from new winners, and pairs that use their new characters
+    chars = set(cat(old_winners))
+    pairs = char_pairs(chars | set(cat(added_winners))) - char_pairs(chars)
+    fresh = candidate_searchers(added_winners, losers, pairs)
+    fresh = {r: fresh[r] for r in fresh if r not in state['pool']}
+    pool.update(match_bits(fresh, winners))
+    searchers.update(fresh)
+    # Warm start: the old solution, plus whole new winners that it misses, if that is valid
+    old, search = state['solution'], re.compile(state['solution']).search
+    if any(search(L) for L in added_losers):
+        solution = '^(' + OR(winners) + ')$'
+    else:
+        solution = OR([old] + ['^'+w+'$' for w in added_winners if not search(w)])
+    state = {'winners': winners, 'losers': losers, 'pool': pool, 'searchers': searchers}
+    return resolve(state, solution, calls, restarts, engine)
+
+def resolve(state, solution, calls=10000, restarts=10, engine=None):
+    "Search state's pool, starting from solution; return state with the solution found."
+    covers = eliminate_dominated_bits(state['pool'])
+    bb = restart_search(covers, solution, calls, restarts, engine=engine)
+    return dict(state, solution=bb.solution)
+
+def solve_corpus(winners_path, losers_path, n=100, rounds=5, seed=0, strata=None, log=False,
+                 calls=10000, restarts=10, engine=None):
+    """Solve for a sample (see sample_corpus) of n User-Agents from each of two files (read
+    as by load_corpus), then check the solution against every distinct User-Agent in them,
+    and update with the (up to n) most frequent ones it gets wrong; repeat, for up to 
+    rounds updates. Return the last state, whose 'errors' is a Counter of the User-Agents
+    that its solution still gets wrong (empty if it is verified on the full files)."""
+    W, L = [load_corpus(path, log, counts=True) for path in (winners_path, losers_path)]
+    state = solve(sample_corpus(W, n, seed, strata), sample_corpus(L, n, seed, strata), 
+                  calls, restarts, engine)
+    for attempt in range(rounds + 1):
+        search = re.compile(state['solution']).search
+        missed = Counter({w: W[w] for w in W if not search(w)})
+        matched = Counter({x: L[x] for x in L if search(x)})
+        state['errors'] = missed + matched
+        print '{:3d} ch {:5,d} winners {:5,d} losers {:7,d} errors round {}: {!r}'.format(
+            len(state['solution']), len(state['winners']), len(state['losers']), 
+            len(state['errors']), attempt, state['solution'])
+        if not state['errors'] or attempt == rounds:
+            return state
+        state = update(state, [w for (w, _) in missed.most_common(n)], 
+                       [x for (x, _) in matched.most_common(n)], calls, restarts, engine)
+
+class CoverCache(object):
+    """An on-disk store of the cover pool (after eliminate_dominated_bits) and best 
+    solution for each problem, keyed by a hash of the winners, losers and the candidate 
+    generator's parameters. It keeps one pickle file per problem in directory (by 
+    default $REGEXGOLF_CACHE or .regexgolf_cache), and evicts the least recently used 
+    files when they total more than max_bytes."""
+
+    version = 1 # Bump when the entry format or regex_bitcovers changes
+
+    def __init__(self, directory=None, max_bytes=64 * 2**20):
+        self.directory = directory or os.environ.get('REGEXGOLF_CACHE', '.regexgolf_cache')
+        self.max_bytes = max_bytes
+
+    def path(self, winners, losers):
+        "The file that holds the entry for this problem."
+        key = repr((self.version, sorted(winners), sorted(losers), subpart_size, rep_chars))
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest() + '.pickle')
+
+    def get(self, winners, losers):
+        """Return the {'covers': ..., 'solution': ...} entry for this problem, or None if it
+        is missing or can't be read (say, truncated, or written by other code)."""
+        path = self.path(winners, losers)
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(path, None) # Mark as recently used
+        except Exception:
+            return None
+        return entry
+
+    def put(self, winners, losers, entry):
+        "Store entry for this problem, then evict old entries if over max_bytes."
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(winners, losers)
+        # Each writer has its own temporary file, so that concurrent puts don't collide
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path) # Readers never see a partial file
+        except:
+            os.remove(tmp)
+            raise
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """Remove least recently used entries (but not keep) until under max_bytes. 
+        A file that another process removes meanwhile counts as evicted."""
+        stats = {}
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stats[path] = os.stat(path)
+                except OSError as error:
+                    if error.errno != errno.ENOENT: raise
+        total = sum(stat.st_size for stat in stats.values())
+        for path in sorted(stats, key=lambda path: stats[path].st_mtime):
+            if total <= self.max_bytes:
+                break
+            if path != keep:
+                try:
+                    os.remove(path)
+                except OSError as error:
+                    if error.errno != errno.ENOENT: raise
+                total -= stats[path].st_size
+
+class UserAgentClassifier(object):
+    """Classify raw User-Agent strings with a golfed regex, such as SOLUTION[mobile, desktop]
+    or better_solution(mobile, desktop). The regex is compiled once, and the labels of the
+    last maxsize distinct strings are kept in an LRU cache, counted by hits and misses.
+    With maxsize <= 0, nothing is cached (as with functools.lru_cache(maxsize=0))."""
+
+    def __init__(self, regex, labels=('mobile', 'desktop'), maxsize=2**16):
+        self.regex, self.labels, self.maxsize = regex, labels, maxsize
+        self.search = re.compile(regex).search
+        # The cache maps ua to a link [prev, next, ua, label] in a circular list that 
+        # runs from the least to the most recently used, with root between the ends.
+        self.cache = {}
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        self.hits = self.misses = 0
+
+    def classify(self, ua):
+        "Return labels[0] if regex matches the normalized ua, else labels[1]."
+        link = self.cache.get(ua)
+        root = self.root
+        if link is not None:
+            self.hits += 1
+            prev, next, _, label = link
+            prev[1], next[0] = next, prev # Unlink, and relink as most recent
+            last = root[0]
+            last[1] = root[0] = link
+            link[0], link[1] = last, root
+            return label
+        self.misses += 1
+        label = self.labels[0] if self.search(normalize(ua)) else self.labels[1]
+        if self.maxsize <= 0:
+            return label
+        if len(self.cache) >= self.maxsize: # Drop the least recent link
+            oldest = root[1]
+            root[1], oldest[1][0] = oldest[1], root
+            del self.cache[oldest[2]]
+        last = root[0]
+        last[1] = root[0] = self.cache[ua] = [last, root, ua, label]
+        return label
+
+    def classify_many(self, uas):
+        "Return a list of the label of each ua in uas."
+        return map(self.classify, uas)
+
+    def recent(self):
+        "The cached strings, from least to most recently used."
+        uas, link = [], self.root[1]
+        while link is not self.root:
+            uas.append(link[2])
+            link = link[1]
+        return uas
+
 ##############################################################################
 
 def words(text): 
@@ -168,7 +1184,15 @@ def words(text):
 
 def phrases(text, sep='/'): 
     "Return a set of all 'sep'-separated phrases in text, uppercased."
-    return frozenset(line.strip() for line in text.replace("(", "<").replace(")", ">").replace("+", "_").upper().split(sep))
+    return frozenset(line.strip() for line in normalize(text).split(sep))
+
+def normalize(text):
+    "Uppercase text, and replace the regex characters '(', ')' and '+' that User-Agents use."
+    if isinstance(text, unicode):
+        return text.replace("(", "<").replace(")", ">").replace("+", "_").upper()
+    return text.translate(NORMALIZE) # In one pass
+
+NORMALIZE = string.maketrans('()+' + string.ascii_lowercase, '<>_' + string.ascii_uppercase)
 
 winners = words('''washington adams jefferson jefferson madison madison monroe 
     monroe adams jackson jackson van-buren harrison polk taylor pierce buchanan 
@@ -323,15 +1347,22 @@ ALL = [
 ]
 ALL = [d for datum in ALL for d in (datum, datum[::-1])] # Add in the reverse versions
 
+PAIRS = [('winners', 'losers'), ('boys', 'girls'), ('nfl_in', 'nfl_out'), ('pharma', 'cities'),
+         ('foo', 'bar'), ('starwars', 'startrek'), ('nouns', 'adverbs'), ('nouns', 'verbs'),
+         ('randoms', 'builtins'), ('dogs', 'cats'), ('mobile', 'desktop')]
+
+DATASETS = {W + '-' + L: (globals()[W], W, L, globals()[L]) # Every example, by name,
+            for pair in PAIRS for (W, L) in (pair, pair[::-1])} # with the reverse versions
+
 SOLUTION = {} # Remember solutions; SOLUTION[W, L] will hold a regex
                
-def benchmark(data=ALL, calls=10000): 
+def benchmark(data=ALL, calls=10000, engine=BranchBoundRandom, cache=None): 
     "Run these data sets; print summaries; return total of solution lengths."
     total = 0
     for (W, Wname, Lname, L) in data:
         re.purge()
         t0 = time.time()
-        bb = bb_findregex(W, L, calls)
+        bb = bb_findregex(W, L, calls, engine=engine, cache=cache)
         t1 = time.time()
         SOLUTION[W, L] = bb.solution
         assert verify(bb.solution, W, L)
@@ -340,6 +1371,143 @@ def benchmark(data=ALL, calls=10000):
         total += len(bb.solution)
     return total
 
+def benchmark_engines(data=ALL, calls=10000, engines=(BranchBoundRandom, BranchBoundUndo),
+                      seed=0):
+    "Print the search calls/sec of each engine, from the same covers and seed."
+    for (W, Wname, Lname, L) in data:
+        _, covers = regex_bitcovers(W, L)
+        covers = eliminate_dominated_bits(covers)
+        for engine in engines:
+            random.seed(seed)
+            bb = engine('^(' + OR(W) + ')$', calls)
+            t0 = time.time()
+            bb.search(covers)
+            t1 = time.time()
+            print '{:3d} ch {:7,d} calls {:9,.0f} calls/s {:17} {}-{}'.format(
+                len(bb.solution), calls - bb.calls, (calls - bb.calls) / (t1 - t0), 
+                engine.__name__, Wname, Lname)
+
+def benchmark_dominated(data=ALL):
+    "Time eliminate_dominated_bits against eliminate_dominated_pairwise on full pools."
+    for (W, Wname, Lname, L) in data:
+        _, covers = regex_bitcovers(W, L)
+        t0 = time.time()
+        fast = eliminate_dominated_bits(covers)
+        t1 = time.time()
+        slow = eliminate_dominated_pairwise(covers)
+        t2 = time.time()
+        assert fast == slow
+        print '{:7,d} pool {:4d} kept {:6.3f} s indexed {:6.3f} s pairwise {}-{}'.format(
+            len(covers), len(fast), t1-t0, t2-t1, Wname, Lname)
+
+def benchmark_pruning(data=[DATASETS['dogs-cats'], DATASETS['mobile-desktop']]):
+    """Check that candidate_searchers makes the same pool as compiling every one of
+    regex_candidates and dropping those that match a loser; print the time of each."""
+    for (W, Wname, Lname, L) in data:
+        losers_str = '\n'.join(L)
+        re.purge()
+        t0 = time.time()
+        eager = {c for (c, search) in compile_searchers(regex_candidates(W)).items()
+                 if not search(losers_str)}
+        t1 = time.time()
+        pruned = set(candidate_searchers(W, L))
+        t2 = time.time()
+        assert pruned == eager
+        print '{:7,d} pool {:6.2f} s eager {:6.2f} s pruned {}-{}'.format(
+            len(pruned), t1-t0, t2-t1, Wname, Lname)
+
+def benchmark_classifier(regex=None, uas=None, n=100000, seed=0):
+    """Time a UserAgentClassifier against re.search on n User-Agents drawn (with 
+    repeats, as in real traffic) from uas, per call and as a batch."""
+    regex = regex or SOLUTION.get((mobile, desktop)) or 'U|AN'
+    random.seed(seed)
+    uas = sorted(uas or (mobile | desktop))
+    traffic = [random.choice(uas) for _ in range(n)]
+    def timed(fn):
+        t0 = time.time()
+        fn()
+        return time.time() - t0
+    raw = timed(lambda: [re.search(regex, normalize(ua)) for ua in traffic])
+    classifier = UserAgentClassifier(regex)
+    single = timed(lambda: [classifier.classify(ua) for ua in traffic])
+    batch = timed(lambda: UserAgentClassifier(regex).classify_many(traffic))
+    for (name, secs) in [('re.search', raw), ('classify', single), ('classify_many', batch)]:
+        print '{:13} {:7.0f} ns/call {:11,.0f} UAs/s'.format(name, 1e9 * secs / n, n / secs)
+    print '{:,d} hits {:,d} misses'.format(classifier.hits, classifier.misses)
+
+PHASES = ('generate', 'eliminate', 'simplify', 'search')
+
+def benchmark_suite(names=sorted(DATASETS), trials=3, calls=10000, restarts=10, seed=0,
+                    engine=None, output='benchmark.json', baseline=None, tolerance=0.25):
+    """Run the named DATASETS trials times each, timing each of the PHASES: 
+    regex_bitcovers, eliminate_dominated_bits, simplify_bitcovers (at the root only; 
+    search simplifies at every node) and restart_search. Restart k of trial t is seeded
+    with (seed + t) * restarts + k, so that no two searches share a seed. Write the 
+    results as JSON to output. If baseline names a JSON file written earlier, print and
+    return the regressions: a longest solution longer than the baseline's, or a median 
+    phase time more than tolerance slower."""
+    engine = engine or BranchBoundRandom
+    results = {}
+    for name in names:
+        (W, Wname, Lname, L) = DATASETS[name]
+        runs = []
+        for trial in range(trials):
+            re.purge()
+            t = [time.time()]
+            _, covers = regex_bitcovers(W, L)
+            t.append(time.time())
+            covers = eliminate_dominated_bits(covers)
+            t.append(time.time())
+            covers, partial = simplify_bitcovers(covers)
+            t.append(time.time())
+            bb = restart_search(covers, '^(' + OR(W) + ')$', calls, restarts, 
+                                (seed + trial) * restarts, engine, partial)
+            t.append(time.time())
+            assert verify(bb.solution, W, L)
+            used = (bb.restarts - 1) * calls + calls - bb.calls
+            runs.append({'seconds': dict(zip(PHASES, [t1 - t0 for (t0, t1) in zip(t, t[1:])])),
+                         'calls': used, 'calls_per_sec': used / max(t[-1] - t[-2], 1e-9),
+                         'length': len(bb.solution), 'solution': bb.solution})
+        results[name] = summary = {
+            'seconds': {phase: median([run['seconds'][phase] for run in runs]) for phase in PHASES},
+            'calls_per_sec': median([run['calls_per_sec'] for run in runs]),
+            'length': max(run['length'] for run in runs),
+            'trials': runs}
+        print '{:3d} ch {:9,.0f} calls/s {} {}'.format(
+            summary['length'], summary['calls_per_sec'], 
+            ' '.join('{} {:6.2f} s'.format(phase, summary['seconds'][phase]) for phase in PHASES),
+            name)
+    report = {'calls': calls, 'restarts': restarts, 'trials': trials, 'seed': seed, 
+              'engine': engine.__name__, 'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    return compare_benchmarks(report, baseline, tolerance) if baseline else []
+
+def compare_benchmarks(report, baseline, tolerance=0.25):
+    """Print and return the regressions of a benchmark_suite report against the one in the
+    baseline file: longer solutions, or median phase times more than tolerance slower."""
+    with open(baseline) as f:
+        old = json.load(f)['results']
+    regressions = []
+    for name in sorted(set(report['results']) & set(old)):
+        new, base = report['results'][name], old[name]
+        if new['length'] > base['length']:
+            regressions.append('{}: length {} > {}'.format(name, new['length'], base['length']))
+        for phase in PHASES:
+            (secs, base_secs) = (new['seconds'][phase], base['seconds'][phase])
+            if secs > base_secs * (1 + tolerance) and secs - base_secs > 0.01:
+                regressions.append('{}: {} {:.3f} s > {:.3f} s'.format(name, phase, secs, base_secs))
+    for regression in regressions:
+        print 'REGRESSION', regression
+    return regressions
+
+def median(numbers):
+    "The middle value of numbers (the mean of the middle two, for an even count)."
+    numbers = sorted(numbers)
+    mid = len(numbers) // 2
+    return numbers[mid] if len(numbers) % 2 else (numbers[mid - 1] + numbers[mid]) / 2
+
 ##############################################################################
 
 def test_bb():
@@ -359,10 +1527,38 @@ def test_bb():
     assert eliminate_dominated(covers3) == {'1': {'w1'}, '2': {'w2'}}
     assert simplify_covers(covers3) == ({}, '1|2')
     assert select_necessary({'a': {'abe'}, 'c': {'cee'}}) == ({}, 'a|c')
+    assert bitcovers(covers1) == (['abe', 'ann'], {'a': 3, 'ab': 1})
+    assert setcovers(*bitcovers(covers3)) == covers3
+    assert eliminate_dominated_bits({'a': 3, 'ab': 1, 'b': 0}) == {'a': 3}
+    assert select_necessary_bits({'a': 1, 'b': 3}) == ({'a': 0}, 'b')
+    assert popcount(0) == 0 and popcount(0b1011) == 3
+    assert members(0) == [] and members(0b1010) == [1, 3]
+    _, covers4 = regex_bitcovers(nfl_in, nfl_out)
+    assert eliminate_dominated_bits(covers4) == eliminate_dominated_pairwise(covers4)
     assert {0, 1, 2} >= {1, 2}
     assert {1, 2} >= {1, 2}
     assert not ({1, 2, 4} >= {1, 3})
     assert bb_findregex(starwars, startrek).solution == ' T|P.*E'
+    assert bb_findregex(starwars, startrek, workers=2, seed=1).solution == ' T|P.*E'
+    runs = [bb_findregex(boys, girls, calls=50, restarts=5, workers=2, seed=3) for _ in '12']
+    assert runs[0].solution == runs[1].solution and runs[0].calls == runs[1].calls
+    assert bb_findregex(starwars, startrek, engine=BranchBoundUndo).solution == ' T|P.*E'
+    assert bb_findregex(starwars, startrek, engine=BestFirstSearch).solution == ' T|P.*E'
+    bb = bb_findregex(starwars, startrek, engine=BestFirstSearch, workers=2)
+    assert bb.solution == ' T|P.*E' and bb.restarts == 1
+    assert abs(cover_lower_bound({'a': 3, 'bcd': 4}, 7) - 6) < 1e-6
+    assert cover_lower_bound({'a': 1}, 3) == float('inf')
+    covers5 = {'a': 3, 'b': 6, 'c': 4, 'ab': 7, 'd': 8}
+    _, covers6 = regex_bitcovers(boys, girls)
+    runs = []
+    for engine in (BranchBoundRandom, BranchBoundUndo):
+        random.seed(7)
+        bb = engine('^(' + OR(boys) + ')$', 100)
+        bb.stats = SearchStats()
+        runs.append((len(bb.search(covers6)), bb.calls, bb.stats.expanded, bb.stats.pruned))
+    assert runs[0] == runs[1]
+    bb = BranchBoundUndo('a|b|c|d', 100)
+    assert sorted(bb.search(covers5).split('|')) == ['ab', 'd'] and covers5 == {'a': 3, 'b': 6, 'c': 4, 'ab': 7, 'd': 8}
     return 'test_bb passes'
 
 def test_rep():
@@ -374,13 +1570,245 @@ def test_rep():
                                   'a.+c', 'a.c*', 'a.c?'}
     assert repetitions('^a..d$') == {'^a+..d$', '^a*..d$', '^a?..d$', 
                                      '^a..d+$', '^a..d*$', '^a..d?$'}
+    assert plain('^a.b') and plain('ab$') and not plain('a*b') and not plain('a^b')
+    assert 'ER.' in loser_parts({'VERB'}) and '^V.R' in loser_parts({'VERB'})
+    assert erased('ab*c') == erased('ab?c') == 'ac' and erased('ab+c') is None
+    for (W, L) in [(boys, girls), ({'one', 'on'}, {'won', 'wuan', 'juan'})]:
+        assert set(candidate_searchers(W, L)) == {c for c in regex_candidates(W) 
+                                                  if not re.search(c, '\n'.join(L), re.M)}
     assert (eliminate_dominated(regex_covers(
            {'one', 'on'}, {'won', 'wuan', 'juan'}))
            == {'e': {'one'}, '^o': {'on', 'one'}})
     return 'test_rep passes'
 
+def test_update():
+    state = solve(starwars - {'THE PHANTOM MENACE'}, startrek - {'THE VOYAGE HOME'})
+    state = update(state, {'THE PHANTOM MENACE'}, {'THE VOYAGE HOME'})
+    assert setcovers(state['winners'], state['pool']) == regex_covers(starwars, startrek)
+    assert verify(state['solution'], starwars, startrek) 
+    assert len(state['solution']) == len(' T|P.*E')
+    assert update(state)['pool'] == state['pool']
+    return 'test_update passes'
+
+def test_pair():
+    for (A, B) in [(boys, girls), (starwars, startrek), (foo, bar)]:
+        forward, reverse = pair_bitcovers(A, B)
+        for ((winners, covers), (W, L)) in [(forward, (A, B)), (reverse, (B, A))]:
+            (winners2, covers2) = regex_bitcovers(W, L)
+            assert winners == winners2
+            assert covers == {r: bits for (r, bits) in covers2.items() if bits}
+    directory = tempfile.mkdtemp()
+    try:
+        cache = CoverCache(directory)
+        (bb1, bb2) = bb_findpair(starwars, startrek, cache=cache)
+        assert bb1.solution == ' T|P.*E' and verify(bb2.solution, startrek, starwars)
+        assert cache.get(starwars, startrek) and cache.get(startrek, starwars)
+        (bb3, bb4) = bb_findpair(starwars, startrek, calls=1, cache=cache) # Warm start
+        assert (bb3.solution, bb4.solution) == (bb1.solution, bb2.solution)
+    finally:
+        shutil.rmtree(directory)
+    t0 = time.time()
+    (bb1, bb2) = bb_findpair(mobile, desktop, deadline=2.0) # Full generation takes 40 s
+    assert time.time() - t0 < 5 and verify(bb1.solution, mobile, desktop)
+    assert verify(bb2.solution, desktop, mobile)
+    return 'test_pair passes'
+
+def test_verify_corpus():
+    directory = tempfile.mkdtemp()
+    try:
+        mobile_path, desktop_path = [os.path.join(directory, name) 
+                                     for name in ('mobile.txt', 'desktop.txt.gz')]
+        with open(mobile_path, 'wb') as f:
+            f.write('\n'.join(sorted(mobile) * 3).lower())
+        with gzip.open(desktop_path, 'wb') as f:
+            f.write('\n'.join(desktop))
+        assert verify_files('U|AN', mobile_path, desktop_path)
+        assert verify_files('U|AN', mobile_path, desktop_path, workers=2, chunksize=3)
+        errors = verify_corpus('U', mobile_path, True, workers=2, chunksize=5)
+        assert set(errors) == {M for M in mobile if 'U' not in M}
+        assert set(errors.values()) == {3}
+        assert len(verify_corpus('U', mobile_path, True, chunksize=1, stop_early=True)) == 1
+    finally:
+        shutil.rmtree(directory)
+    return 'test_verify_corpus passes'
+
+def test_corpus():
+    assert normalize('Mozilla/5.0 (iPhone; U+1)') == 'MOZILLA/5.0 <IPHONE; U_1>'
+    assert normalize(u'Mozilla (x+)') == u'MOZILLA <X_>'
+    assert log_agent('1.2.3.4 - - [01/Jan/2015] "GET / HTTP/1.1" 200 5 "-" "Opera/9.80"\n'
+                     ) == 'Opera/9.80'
+    assert log_agent('1.2.3.4 - - [01/Jan/2015] "GET / HTTP/1.1" 200 5 "-" "-"') == ''
+    directory = tempfile.mkdtemp()
+    try:
+        mobile_path, log_path, desktop_path = [os.path.join(directory, name) 
+                                     for name in ('mobile.txt', 'mobile.log', 'desktop.txt.gz')]
+        uas = sorted(mobile)
+        with open(mobile_path, 'wb') as f, open(log_path, 'wb') as log:
+            for (i, ua) in enumerate(uas):
+                for _ in range(i + 1):
+                    f.write(ua.lower() + '\n')
+                    log.write('1.2.3.4 - - [01/Jan/2015] "GET / HTTP/1.1" 200 5 "-" "{}"\n'
+                              .format(ua))
+        with gzip.open(desktop_path, 'wb') as f:
+            f.write('\n'.join(desktop) + '\n\n')
+        assert load_corpus(desktop_path) == desktop
+        counts = load_corpus(log_path, log=True, counts=True)
+        assert counts == load_corpus(mobile_path, counts=True)
+        assert counts == Counter({ua: i + 1 for (i, ua) in enumerate(uas)})
+        sample = sample_corpus(counts, 5, seed=1)
+        assert len(sample) == 5 and sample <= mobile
+        assert sample == sample_corpus(counts, 5, seed=1)
+        android = lambda ua: 'ANDROID' in ua
+        sample = sample_corpus(counts, 3, seed=1, strata=android)
+        assert len(sample) == 3 and {android(ua) for ua in sample} == {True, False}
+        assert sample_corpus(counts, 100) == mobile
+        assert verify_corpus('U|AN', log_path, True, log=True) == Counter()
+        state = solve_corpus(mobile_path, desktop_path, n=4, rounds=10)
+        assert not state['errors'] and verify(state['solution'], mobile, desktop)
+        assert len(state['winners']) < len(mobile) + 4
+    finally:
+        shutil.rmtree(directory)
+    return 'test_corpus passes'
+
+def test_classifier():
+    classifier = UserAgentClassifier('U|AN', maxsize=2)
+    assert classifier.classify('Mozilla/5.0 (Android; Mobile; rv:14.0)') == 'mobile'
+    assert classifier.classify('Mozilla/5.0 (Windows NT 6.1)') == 'desktop'
+    assert classifier.classify_many(['Mozilla/5.0 (Android; Mobile; rv:14.0)', 'Opera/9.80']) == [
+        'mobile', 'desktop']
+    assert (classifier.hits, classifier.misses) == (1, 3)
+    assert classifier.recent() == ['Mozilla/5.0 (Android; Mobile; rv:14.0)', 'Opera/9.80']
+    classifier.classify('Mozilla/5.0 (Android; Mobile; rv:14.0)')
+    assert classifier.recent() == ['Opera/9.80', 'Mozilla/5.0 (Android; Mobile; rv:14.0)']
+    uncached = UserAgentClassifier('U|AN', maxsize=0)
+    assert uncached.classify_many(['Opera/9.80'] * 2) == ['desktop', 'desktop']
+    assert (uncached.hits, uncached.misses) == (0, 2) and uncached.recent() == []
+    return 'test_classifier passes'
+
+def test_benchmark_suite():
+    directory = tempfile.mkdtemp()
+    try:
+        base, out = os.path.join(directory, 'base.json'), os.path.join(directory, 'out.json')
+        names = ['starwars-startrek', 'startrek-starwars']
+        assert benchmark_suite(names, trials=2, output=base) == []
+        report = json.load(open(base))
+        assert report['results']['starwars-startrek']['length'] == len(' T|P.*E')
+        assert len(report['results']['startrek-starwars']['trials']) == 2
+        report['results']['starwars-startrek']['length'] = 1
+        json.dump(report, open(base, 'w'))
+        regressions = benchmark_suite(names[:1], trials=1, output=out, baseline=base)
+        assert regressions[0] == 'starwars-startrek: length 7 > 1'
+    finally:
+        shutil.rmtree(directory)
+    assert median([3, 1, 2]) == 2 and median([4, 1, 2, 3]) == 2.5
+    return 'test_benchmark_suite passes'
+
+def test_stats():
+    events = Counter()
+    stats = SearchStats(callback=lambda kind, stats: events.update([kind]))
+    bb = bb_findregex(boys, girls, stats=stats)
+    assert len(bb.solution) == len(stats.improvements[-1][1]) == 11
+    assert stats.expanded == events['expand'] and stats.pruned == events['prune'] > 0
+    assert len(stats.improvements) == events['improve'] > 0
+    assert sum(stats.iterations.values()) >= stats.expanded + stats.pruned
+    assert 0 < stats.cumulative('eliminate_dominated') < stats.cumulative('simplify_covers')
+    assert stats.cumulative('simplify_covers') <= stats.cumulative('search')
+    out = StringIO()
+    stats.dump_folded(out)
+    assert [line.split()[0] for line in out.getvalue().splitlines()] == [
+        'search;simplify_covers', 'search;simplify_covers;eliminate_dominated',
+        'search;simplify_covers;select_necessary', 'search']
+    undo = SearchStats()
+    bb = bb_findregex(boys, girls, stats=undo, engine=BranchBoundUndo)
+    assert undo.expanded > 0 and undo.pruned > 0 and len(undo.improvements[-1][1]) == 11
+    assert 0 < undo.cumulative('simplify_covers') <= undo.cumulative('search')
+    try:
+        bb_findregex(boys, girls, stats=SearchStats(), engine=BestFirstSearch)
+        assert False, 'BestFirstSearch does not report to SearchStats'
+    except ValueError:
+        pass
+    try:
+        bb_findregex(boys, girls, stats=SearchStats(), workers=2)
+        assert False, 'worker processes do not report to SearchStats'
+    except ValueError:
+        pass
+    return 'test_stats passes'
+
+def test_anytime():
+    improved = []
+    bb = bb_findregex(boys, girls, calls=10**6, deadline=60, on_improve=improved.append)
+    assert not bb.stopped and verify(bb.solution, boys, girls)
+    assert [len(s) for s in improved] == sorted(set(map(len, improved)), reverse=True)
+    assert len(improved[-1]) == len(bb.solution)
+    bb = bb_findregex(boys, girls, deadline=0) # Only whole winners, so no improvement
+    assert bb.solution == '^(' + OR(boys) + ')$'
+    directory = tempfile.mkdtemp()
+    try:
+        cache = CoverCache(directory)
+        bb_findregex(boys, girls, deadline=60, cache=cache) # Time to spare: the pool is whole
+        assert cache.get(boys, girls)
+        t0 = time.time()
+        bb = bb_findregex(mobile, desktop, deadline=5.0, cache=cache) # Generation takes 20 s
+        assert time.time() - t0 < 5.5 and verify(bb.solution, mobile, desktop)
+        assert len(bb.solution) < len('^(' + OR(mobile) + ')$')
+        assert cache.get(mobile, desktop) is None # A cut pool is not worth keeping
+    finally:
+        shutil.rmtree(directory)
+    search = BackgroundSearch(starwars, startrek, calls=10**7, restarts=10**6)
+    done = []
+    search.add_done_callback(done.append)
+    time.sleep(0.5)
+    assert not search.done() and search.cancel()
+    assert verify(search.result(timeout=60), starwars, startrek) and done == [search]
+    assert search.best == search.result()
+    try:
+        BackgroundSearch(boys, girls, workers=2).result(timeout=60)
+        assert False, 'a worker process cannot be cancelled'
+    except ValueError:
+        pass
+    return 'test_anytime passes'
+
+def test_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        cache = CoverCache(directory)
+        assert cache.get(starwars, startrek) is None
+        bb = bb_findregex(starwars, startrek, cache=cache)
+        entry = cache.get(starwars, startrek)
+        assert entry['solution'] == bb.solution == ' T|P.*E'
+        assert setcovers(sorted(starwars), entry['covers']) == eliminate_dominated(
+               regex_covers(starwars, startrek))
+        assert bb_findregex(starwars, startrek, calls=1, cache=cache).solution == ' T|P.*E'
+        assert cache.get(startrek, starwars) is None
+        for garbage in ('cnosuchmodule\nx\n.', 'c__builtin__\nnosuchname\n.', 
+                        pickle.dumps({'covers': {}}, 2)[:-3]):
+            with open(cache.path(startrek, starwars), 'wb') as f:
+                f.write(garbage)
+            assert cache.get(startrek, starwars) is None
+        cache.put(startrek, starwars, {'covers': {}, 'solution': 'x' * 10000})
+        os.utime(cache.path(startrek, starwars), (0, 0)) # Least recently used
+        assert not [name for name in os.listdir(directory) if name.endswith('.tmp')]
+        CoverCache(directory, max_bytes=5000).evict()
+        vanished = os.path.join(directory, 'vanished.pickle') # As if evicted by another process
+        os.symlink(os.path.join(directory, 'nowhere'), vanished)
+        CoverCache(directory, max_bytes=10**6).evict()
+        os.remove(vanished)
+        assert os.listdir(directory) == [os.path.basename(cache.path(starwars, startrek))]
+    finally:
+        shutil.rmtree(directory)
+    return 'test_cache passes'
+
 if __name__ == '__main__':
     print test_rep()
     print test_bb()
-    total = benchmark()
+    print test_update()
+    print test_pair()
+    print test_verify_corpus()
+    print test_corpus()
+    print test_classifier()
+    print test_benchmark_suite()
+    print test_stats()
+    print test_anytime()
+    print test_cache()
+    total = benchmark(cache=CoverCache())
     print 'benchmark total', total